@@ -0,0 +1,25 @@
+"""
+Gunicorn configuration for the ZTAP Anomaly Detection Service
+
+Usage: gunicorn -c gunicorn_conf.py service:app
+"""
+
+import multiprocessing
+import os
+
+bind = os.environ.get('GUNICORN_BIND', '0.0.0.0:5000')
+
+# One process per core (plus one) so /detect and /predict are served in parallel
+workers = int(os.environ.get('GUNICORN_WORKERS', multiprocessing.cpu_count() * 2 + 1))
+
+# gthread gives real parallelism because scikit-learn releases the GIL inside
+# predict; set GUNICORN_WORKER_CLASS=gevent for I/O-bound deployments
+# (requires the gevent package)
+worker_class = os.environ.get('GUNICORN_WORKER_CLASS', 'gthread')
+threads = int(os.environ.get('GUNICORN_THREADS', 4))
+
+# Load the app (and any persisted model) once in the master before forking
+preload_app = True
+
+backlog = 2048
+keepalive = 5
@@ -1,83 +1,374 @@
 #!/usr/bin/env python3
 """
 ZTAP Anomaly Detection Microservice
-Uses Isolation Forest for detecting anomalous network flows
+Uses HBOS (default) or Isolation Forest for detecting anomalous network flows
 """
 
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, stream_with_context
+import joblib
+from joblib import parallel_backend
 from sklearn.ensemble import IsolationForest
+from hbos import HBOS
 import numpy as np
+import orjson
 import json
+import os
+import queue
+import random
+import threading
+import time
+import zlib
+from concurrent.futures import Future, ThreadPoolExecutor
 from datetime import datetime
+from functools import lru_cache
 
 app = Flask(__name__)
 
-# Global model (in production, use persistent storage)
+# Global model, persisted under MODEL_PATH when it is set
 model = None
 training_data = []
 
+MODEL_PATH = os.environ.get('MODEL_PATH')
+MODEL_FILE = os.path.join(MODEL_PATH, 'model.joblib') if MODEL_PATH else None
+_model_mtime = None
+
+# Detector used by /train: 'hbos' or 'isolation_forest'
+MODEL_KIND = os.environ.get('MODEL_KIND', 'hbos')
+
+# IsolationForest size; scoring cost is linear in the number of trees
+IFOREST_ESTIMATORS = int(os.environ.get('IFOREST_ESTIMATORS', 50))
+IFOREST_MAX_SAMPLES = int(os.environ.get('IFOREST_MAX_SAMPLES', 256))
+IFOREST_MAX_FEATURES = float(os.environ.get('IFOREST_MAX_FEATURES', 1.0))
+
+# Larger training payloads are down-sampled to this many flows
+MAX_TRAIN = int(os.environ.get('MAX_TRAIN', 20000))
+
+# Micro-batching limits for /predict
+BATCH_MAX = int(os.environ.get('BATCH_MAX', 64))
+BATCH_WAIT_MS = float(os.environ.get('BATCH_WAIT_MS', 10))
+
+# Flows extracted and scored per chunk by /batch_predict and /batch_predict_stream
+SCORE_CHUNK = int(os.environ.get('SCORE_CHUNK', 4096))
+
+# Protocol to numeric (default to 0 for unknown)
+PROTOCOL_MAP = {'TCP': 1, 'UDP': 2, 'ICMP': 3}
+
+# Ports flagged by the rule-based fallback (SSH, Telnet, RDP, databases)
+SUSPICIOUS_PORTS = frozenset({22, 23, 3389, 1433, 3306, 5432})
+
+@lru_cache(maxsize=65536)
+def _ip_to_int(ip):
+    """Encode an IP address string as a uint32 feature
+
+    Dotted-quad IPv4 addresses are packed big-endian, so addresses in the
+    same subnet get nearby values. Anything else (IPv6, hostnames, garbage,
+    or non-string JSON values such as null) falls back to a CRC32 of its
+    string form, which unlike hash() is stable across processes and restarts.
+    """
+    if not isinstance(ip, str):
+        ip = str(ip)
+    parts = ip.split('.')
+    # isdecimal() alone admits non-ASCII digits that int() may reject
+    if len(parts) == 4 and all(p.isascii() and p.isdecimal() and int(p) < 256 for p in parts):
+        a, b, c, d = map(int, parts)
+        return (a << 24) | (b << 16) | (c << 8) | d
+    return zlib.crc32(ip.encode())
+
+def ip_to_u32(ips):
+    """Encode a sequence of IP address strings as a uint32 array"""
+    return np.fromiter((_ip_to_int(ip) for ip in ips), dtype=np.uint32, count=len(ips))
+
+def _ts_hour(timestamp):
+    """Parse the hour of day from an ISO-8601 timestamp
+
+    The hour sits at a fixed offset in 'YYYY-MM-DDTHH...' strings, so it is
+    sliced out directly; other ISO forms fall back to fromisoformat.
+    """
+    if len(timestamp) >= 13 and timestamp[10] in 'T ' and timestamp[11:13].isdecimal():
+        hour = int(timestamp[11:13])
+        if hour < 24:
+            return hour
+    # Anything unusual, including out-of-range hours, gets full validation
+    return datetime.fromisoformat(timestamp).hour
+
 def extract_features(flow):
     """Extract numeric features from flow record"""
-    # Convert IP addresses to numeric (simple hash for demo)
-    source_hash = hash(flow.get('source_ip', '0.0.0.0')) % 10000
-    dest_hash = hash(flow.get('dest_ip', '0.0.0.0')) % 10000
+    # Convert IP addresses to numeric
+    source_ip = _ip_to_int(flow.get('source_ip', '0.0.0.0'))
+    dest_ip = _ip_to_int(flow.get('dest_ip', '0.0.0.0'))
     
-    # Protocol to numeric (default to 0 for unknown)
-    protocol_map = {'TCP': 1, 'UDP': 2, 'ICMP': 3}
-    protocol_num = protocol_map.get(flow.get('protocol', ''), 0)
+    protocol_num = PROTOCOL_MAP.get(flow.get('protocol', ''), 0)
     
-    # Features: [source_hash, dest_hash, port, protocol, bytes, hour_of_day]
-    timestamp = flow.get('timestamp', datetime.now().isoformat())
-    hour = datetime.fromisoformat(timestamp).hour if timestamp else 0
+    # Features: [source_ip, dest_ip, port, protocol, bytes, hour_of_day]
+    if 'timestamp' in flow:
+        hour = _ts_hour(flow['timestamp']) if flow['timestamp'] else 0
+    else:
+        hour = datetime.now().hour
     
     return [
-        source_hash,
-        dest_hash,
+        source_ip,
+        dest_ip,
         flow.get('port', 0),
         protocol_num,
         flow.get('bytes', 0),
         hour
     ]
 
+def extract_features_batch(flows, out=None):
+    """Extract the feature matrix for a list of flow records
+
+    Builds each feature column in a single pass over the flows at its
+    narrowest safe dtype and packs them with build_features, matching
+    extract_features row-wise. Rows are written into out when given.
+    """
+    n = len(flows)
+    default_hour = datetime.now().hour
+
+    return build_features(
+        ip_to_u32([f.get('source_ip', '0.0.0.0') for f in flows]),
+        ip_to_u32([f.get('dest_ip', '0.0.0.0') for f in flows]),
+        # Ports and byte counts are taken as sent (fractional or beyond the
+        # int32 range), like extract_features, so they go straight to float32
+        np.fromiter((f.get('port', 0) for f in flows), dtype=np.float32, count=n),
+        np.fromiter(
+            (PROTOCOL_MAP.get(f.get('protocol', ''), 0) for f in flows), dtype=np.int8, count=n),
+        np.fromiter((f.get('bytes', 0) for f in flows), dtype=np.float32, count=n),
+        np.fromiter(
+            ((_ts_hour(f['timestamp']) if f['timestamp'] else 0)
+             if 'timestamp' in f else default_hour
+             for f in flows),
+            dtype=np.int8, count=n),
+        out=out
+    )
+
+def build_features(source_ips, dest_ips, ports, protocols, byte_counts, hours, out=None):
+    """Pack pre-parsed numeric feature columns into an (N, 6) float32 matrix
+
+    For ingest paths that already carry uint32 IPs, protocol numbers and
+    hours of day, this skips all per-flow string handling. float32 is the
+    dtype IsolationForest works in, so sklearn does not copy the result.
+    Pass a preallocated float32 buffer as out to reuse it across calls; the
+    first N rows are filled and returned.
+    """
+    n = len(ports)
+    X = np.empty((n, 6), dtype=np.float32) if out is None else out[:n]
+    X[:, 0] = source_ips
+    X[:, 1] = dest_ips
+    X[:, 2] = ports
+    X[:, 3] = protocols
+    X[:, 4] = byte_counts
+    X[:, 5] = hours
+    return X
+
+def ojson(obj):
+    """Build a JSON response with orjson, serializing numpy values natively"""
+    return app.response_class(
+        orjson.dumps(obj, option=orjson.OPT_SERIALIZE_NUMPY),
+        mimetype='application/json'
+    )
+
+def build_model(n_samples):
+    """Create an unfitted detector of the configured MODEL_KIND for n_samples flows"""
+    if MODEL_KIND == 'isolation_forest':
+        return IsolationForest(
+            contamination=0.1,  # Expect 10% anomalies
+            random_state=42,
+            n_estimators=IFOREST_ESTIMATORS,
+            max_samples=min(IFOREST_MAX_SAMPLES, n_samples),
+            max_features=IFOREST_MAX_FEATURES,
+            n_jobs=-1  # Fit trees in parallel
+        )
+    return HBOS(contamination=0.1)
+
+class PredictBatcher:
+    """Aggregates single-flow predictions into one model call
+
+    Requests are queued with a Future; a background thread collects up to
+    max_batch of them, waiting at most max_wait_ms after the first one
+    arrives, and scores the stacked rows with a single decision_function
+    call.
+    """
+
+    def __init__(self, max_batch=BATCH_MAX, max_wait_ms=BATCH_WAIT_MS):
+        self.max_batch = max(1, max_batch)
+        self.max_wait = max_wait_ms / 1000.0
+        self._lock = threading.Lock()
+        self._queue = None
+        self._pid = None
+
+    def submit(self, estimator, features):
+        """Queue a feature row; the Future resolves to its anomaly score"""
+        future = Future()
+        self._ensure_worker().put((estimator, features, future))
+        return future
+
+    def _ensure_worker(self):
+        # Threads do not survive fork, so each worker process starts its own
+        with self._lock:
+            if self._pid != os.getpid():
+                self._queue = queue.Queue()
+                self._pid = os.getpid()
+                threading.Thread(target=self._run, args=(self._queue,), daemon=True).start()
+            return self._queue
+
+    def _run(self, pending):
+        while True:
+            items = [pending.get()]
+            deadline = time.monotonic() + self.max_wait
+            while len(items) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    items.append(pending.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            self._process(items)
+
+    def _process(self, items):
+        # A retrain can swap the model mid-batch; score each model's rows separately
+        groups = {}
+        for estimator, features, future in items:
+            groups.setdefault(id(estimator), (estimator, []))[1].append((features, future))
+
+        for estimator, rows in groups.values():
+            try:
+                X = np.asarray([features for features, _ in rows], dtype=np.float32)
+                scores = estimator.decision_function(X)
+            except Exception as exc:
+                for _, future in rows:
+                    future.set_exception(exc)
+                continue
+            for (_, future), score in zip(rows, scores):
+                future.set_result(score)
+
+batcher = PredictBatcher()
+
+@lru_cache(maxsize=4096)
+def _score_features(estimator, features):
+    """Score one feature tuple with the given model
+
+    Keyed on the estimator as well, so a score computed by a model that was
+    swapped out mid-request can never be served for its replacement; the
+    cache is still cleared on retrain to release old models.
+
+    IsolationForest.predict is just decision_function < 0, so a single
+    decision_function pass yields both the score and the label. HBOS is
+    cheap enough to score inline; IsolationForest goes through the batcher.
+    """
+    if isinstance(estimator, HBOS):
+        return estimator.decision_function(np.asarray([features], dtype=np.float32))[0]
+    return batcher.submit(estimator, features).result()
+
+def load_model():
+    """Load the persisted model if it changed on disk since the last load
+
+    Arrays are memory-mapped read-only, and a model trained by another
+    worker is picked up on that worker's next request. A file that cannot
+    be loaded (corrupt, or pickled by another library version) is logged
+    and skipped until it changes again; the current model, or the
+    rule-based fallback when there is none, keeps serving.
+    """
+    global model, _model_mtime
+    
+    if not MODEL_FILE:
+        return
+    try:
+        mtime = os.stat(MODEL_FILE).st_mtime_ns
+    except FileNotFoundError:
+        return
+    if mtime == _model_mtime:
+        return
+    
+    # Record the mtime first so a bad file is not re-read on every request
+    _model_mtime = mtime
+    try:
+        loaded = joblib.load(MODEL_FILE, mmap_mode='r')
+        if not hasattr(loaded, 'decision_function'):
+            raise TypeError(f'{type(loaded).__name__} is not an anomaly detector')
+    except Exception:
+        app.logger.exception('Failed to load model from %s; keeping current model', MODEL_FILE)
+        return
+    
+    model = loaded
+    _score_features.cache_clear()
+
+def save_model(estimator):
+    """Persist a fitted model so other workers and restarts can load it"""
+    global _model_mtime
+    
+    if not MODEL_FILE:
+        return
+    os.makedirs(os.path.dirname(MODEL_FILE), exist_ok=True)
+    
+    # Write then rename so readers never see a partial file
+    tmp_file = f'{MODEL_FILE}.{os.getpid()}.tmp'
+    joblib.dump(estimator, tmp_file, compress=0)
+    os.replace(tmp_file, MODEL_FILE)
+    _model_mtime = os.stat(MODEL_FILE).st_mtime_ns
+
+def warm_up():
+    """Run feature extraction and a throwaway fit/score of each detector
+
+    Pays first-call costs (lazy imports, tree module setup, BLAS init) at
+    boot instead of on the first request; with Gunicorn's preload_app this
+    happens once in the master and is shared by the forked workers.
+    """
+    X = extract_features_batch([{'timestamp': '1970-01-01T00:00:00'}, {}])
+    for estimator in (IsolationForest(n_estimators=10, random_state=42), HBOS()):
+        estimator.fit(X).decision_function(X[:1])
+    orjson.dumps(X, option=orjson.OPT_SERIALIZE_NUMPY)
+
+warm_up()
+load_model()
+
+@app.before_request
+def sync_model():
+    """Pick up a model retrained by another worker"""
+    load_model()
+
 @app.route('/health', methods=['GET'])
 def health():
     """Health check endpoint"""
-    return jsonify({'status': 'healthy', 'model_trained': model is not None})
+    return ojson({'status': 'healthy', 'model_trained': model is not None})
 
 @app.route('/train', methods=['POST'])
 def train():
-    """Train the Isolation Forest model on normal traffic"""
+    """Train the anomaly detection model on normal traffic"""
     global model, training_data
     
     data = request.json
     if not data:
-        return jsonify({'error': 'Expected JSON data'}), 400
+        return ojson({'error': 'Expected JSON data'}), 400
     
     # Handle both formats: direct list or {'flows': [...]}
     flows = data.get('flows', data) if isinstance(data, dict) else data
     
     if not flows or not isinstance(flows, list):
-        return jsonify({'error': 'Expected list of flows'}), 400
+        return ojson({'error': 'Expected list of flows'}), 400
     
     # Require minimum samples for training
     if len(flows) < 2:
-        return jsonify({'error': 'Insufficient training data (minimum 2 samples required)'}), 400
+        return ojson({'error': 'Insufficient training data (minimum 2 samples required)'}), 400
+    
+    # Bound fit latency: detectors gain nothing from tens of thousands of
+    # normal flows, so sample a fixed-size subset of large payloads
+    if len(flows) > MAX_TRAIN:
+        flows = random.Random(42).sample(flows, MAX_TRAIN)
     
     # Extract features
-    features = [extract_features(flow) for flow in flows]
-    X = np.array(features)
-    
-    # Train model
-    model = IsolationForest(
-        contamination=0.1,  # Expect 10% anomalies
-        random_state=42,
-        n_estimators=100
-    )
-    model.fit(X)
+    X = extract_features_batch(flows)
+    
+    # Train model; publish it only once fitted so concurrent requests in
+    # this worker never see an unfitted estimator
+    estimator = build_model(len(X)).fit(X)
+    model = estimator
+    _score_features.cache_clear()
+    save_model(estimator)
     
     training_data = flows
     
-    return jsonify({
+    return ojson({
         'status': 'trained',
         'samples': len(flows),
         'features': X.shape[1]
@@ -86,36 +377,35 @@ def train():
 @app.route('/detect', methods=['POST'])
 def detect():
     """Detect if a flow is anomalous"""
-    global model
+    # Score with the model that was current when the request started
+    estimator = model
     
-    if model is None:
+    if estimator is None:
         # Use simple heuristic if not trained
         return simple_detect(request.json)
     
     flow = request.json
     if not flow:
-        return jsonify({'error': 'Expected flow object'}), 400
+        return ojson({'error': 'Expected flow object'}), 400
     
     # Extract features
     features = extract_features(flow)
-    X = np.array([features])
     
-    # Predict (-1 = anomaly, 1 = normal)
-    prediction = model.predict(X)[0]
-    anomaly_score = model.decision_function(X)[0]
+    # Negative decision scores are anomalies
+    anomaly_score = _score_features(estimator, tuple(features))
     
     # Convert to 0-100 scale (lower anomaly_score = more anomalous)
     # Typical range is [-0.5, 0.5], normalize to [0, 100]
     score = max(0, min(100, (1 - anomaly_score) * 100))
     
-    is_anomaly = prediction == -1
+    is_anomaly = anomaly_score < 0
     reason = "ML-based detection: "
     if is_anomaly:
         reason += "flow deviates from normal patterns"
     else:
         reason += "flow matches normal patterns"
     
-    return jsonify({
+    return ojson({
         'score': float(score),
         'is_anomaly': bool(is_anomaly),
         'reason': reason
@@ -124,29 +414,28 @@ def detect():
 @app.route('/predict', methods=['POST'])
 def predict():
     """Predict if a single flow is anomalous (requires trained model)"""
-    global model
+    # Score with the model that was current when the request started
+    estimator = model
     
-    if model is None:
-        return jsonify({'error': 'Model not trained. Call /train first.'}), 400
+    if estimator is None:
+        return ojson({'error': 'Model not trained. Call /train first.'}), 400
     
     flow = request.json
     if not flow:
-        return jsonify({'error': 'Expected flow object'}), 400
+        return ojson({'error': 'Expected flow object'}), 400
     
     # Extract features
     features = extract_features(flow)
-    X = np.array([features])
     
-    # Predict (-1 = anomaly, 1 = normal)
-    prediction = model.predict(X)[0]
-    anomaly_score = model.decision_function(X)[0]
+    # Negative decision scores are anomalies; batched with concurrent requests
+    anomaly_score = _score_features(estimator, tuple(features))
     
     # Convert to 0-100 scale
     score = max(0, min(100, (1 - anomaly_score) * 100))
     
-    is_anomaly = prediction == -1
+    is_anomaly = anomaly_score < 0
     
-    return jsonify({
+    return ojson({
         'is_anomaly': bool(is_anomaly),
         'anomaly': bool(is_anomaly),
         'score': float(score),
@@ -159,46 +448,142 @@ def batch_predict():
     global model
     
     if model is None:
-        return jsonify({'error': 'Model not trained. Call /train first.'}), 400
+        return ojson({'error': 'Model not trained. Call /train first.'}), 400
     
     data = request.json
     if not data:
-        return jsonify({'error': 'Expected JSON data'}), 400
+        return ojson({'error': 'Expected JSON data'}), 400
     
     # Handle both formats: direct list or {'flows': [...]}
     flows = data.get('flows', data) if isinstance(data, dict) else data
     
     if not flows or not isinstance(flows, list):
-        return jsonify({'error': 'Expected list of flows'}), 400
+        return ojson({'error': 'Expected list of flows'}), 400
     
-    # Extract features for all flows
-    features = [extract_features(flow) for flow in flows]
-    X = np.array(features)
-    
-    # Predict for all flows
-    predictions = model.predict(X)
-    scores = model.decision_function(X)
-    
-    # Format results
-    results = []
-    for i, (pred, score) in enumerate(zip(predictions, scores)):
-        is_anomaly = pred == -1
-        normalized_score = max(0, min(100, (1 - score) * 100))
-        
-        results.append({
-            'index': i,
-            'is_anomaly': bool(is_anomaly),
-            'anomaly': bool(is_anomaly),
-            'score': float(normalized_score),
-            'confidence': float(abs(score))
-        })
+    scores = score_flows(model, flows)
+    results = format_predictions(range(len(flows)), scores)
     
-    return jsonify({
+    return ojson({
         'predictions': results,
         'total': len(results),
-        'anomalies': sum(1 for r in results if r['is_anomaly'])
+        'anomalies': int((scores < 0).sum())
     })
 
+@app.route('/batch_predict_stream', methods=['POST'])
+def batch_predict_stream():
+    """Predict anomalies for newline-delimited JSON flows, streaming results
+
+    Flows are read and scored in chunks of SCORE_CHUNK, so memory stays
+    bounded by the chunk size rather than the payload size. Each output
+    line is a prediction (or an error for a line that is not a valid flow)
+    carrying the index of its input line.
+    """
+    # Score the whole stream with the model that was current when it started
+    estimator = model
+    if estimator is None:
+        return ojson({'error': 'Model not trained. Call /train first.'}), 400
+    
+    def generate():
+        buffer = np.empty((SCORE_CHUNK, 6), dtype=np.float32)
+        indices = []
+        
+        def flush():
+            scores = score_batch(estimator, buffer[:len(indices)])
+            results = format_predictions(indices, scores)
+            indices.clear()
+            return b''.join(orjson.dumps(r) + b'\n' for r in results)
+        
+        for i, line in enumerate(request.stream):
+            if not line.strip():
+                continue
+            try:
+                flow = orjson.loads(line)
+            except orjson.JSONDecodeError:
+                flow = None
+            if not isinstance(flow, dict):
+                yield orjson.dumps({'index': i, 'error': 'Expected flow object'}) + b'\n'
+                continue
+            
+            # Extract as each line arrives: once streaming has started a bad
+            # field can only fail its own line, not the whole response
+            try:
+                row = buffer[len(indices)]
+                row[:] = extract_features(flow)
+                # NumPy silently turns null fields into NaN
+                if not np.isfinite(row).all():
+                    raise ValueError('non-numeric feature value')
+            except (TypeError, ValueError, OverflowError) as exc:
+                yield orjson.dumps({'index': i, 'error': f'Invalid flow: {exc}'}) + b'\n'
+                continue
+            
+            indices.append(i)
+            if len(indices) == SCORE_CHUNK:
+                yield flush()
+        
+        if indices:
+            yield flush()
+    
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+def score_flows(estimator, flows):
+    """Extract features for and score a list of flows
+
+    Large batches are split into SCORE_CHUNK-sized chunks: while one chunk
+    is scored on a background thread (sklearn and NumPy release the GIL),
+    the next chunk's features are extracted on this one.
+    """
+    if len(flows) <= SCORE_CHUNK:
+        return score_batch(estimator, extract_features_batch(flows))
+    
+    X = np.empty((len(flows), 6), dtype=np.float32)
+    scores = np.empty(len(flows))
+    
+    def score_chunk(start, end):
+        scores[start:end] = score_batch(estimator, X[start:end])
+    
+    # A single scorer keeps chunks from oversubscribing the joblib backend
+    with ThreadPoolExecutor(max_workers=1) as scorer:
+        pending = []
+        for start in range(0, len(flows), SCORE_CHUNK):
+            end = start + SCORE_CHUNK
+            extract_features_batch(flows[start:end], out=X[start:end])
+            pending.append(scorer.submit(score_chunk, start, end))
+        for future in pending:
+            future.result()
+    
+    return scores
+
+def score_batch(estimator, X):
+    """Score a feature matrix; negative decision scores are anomalies
+
+    Since scikit-learn 1.6, IsolationForest walks its trees through joblib
+    at predict time, but ignores the estimator's n_jobs there; the threading
+    backend set here is what parallelizes the traversal.
+    """
+    with parallel_backend('threading', n_jobs=os.cpu_count()):
+        return estimator.decision_function(X)
+
+def format_predictions(indices, scores):
+    """Build prediction dicts for scored flows
+
+    Result fields are computed as arrays and converted to Python once.
+    """
+    is_anomaly = scores < 0
+    normalized_scores = np.clip((1 - scores) * 100, 0, 100)
+    confidences = np.abs(scores)
+    
+    return [
+        {
+            'index': i,
+            'is_anomaly': anomaly,
+            'anomaly': anomaly,
+            'score': score,
+            'confidence': confidence
+        }
+        for i, anomaly, score, confidence in zip(
+            indices, is_anomaly.tolist(), normalized_scores.tolist(), confidences.tolist())
+    ]
+
 
 def simple_detect(flow):
     """Simple rule-based detection (fallback when model not trained)"""
@@ -206,8 +591,7 @@ def simple_detect(flow):
     reasons = []
     
     # Check suspicious ports
-    suspicious_ports = [22, 23, 3389, 1433, 3306, 5432]
-    if flow.get('port') in suspicious_ports:
+    if flow.get('port') in SUSPICIOUS_PORTS:
         score += 30
         reasons.append(f"suspicious port {flow.get('port')}")
     
@@ -217,15 +601,17 @@ def simple_detect(flow):
         reasons.append("high data transfer volume")
     
     # Check unusual hour (outside business hours)
-    timestamp = flow.get('timestamp', datetime.now().isoformat())
-    hour = datetime.fromisoformat(timestamp).hour if timestamp else 12
+    if 'timestamp' in flow:
+        hour = _ts_hour(flow['timestamp']) if flow['timestamp'] else 12
+    else:
+        hour = datetime.now().hour
     if hour < 6 or hour > 20:
         score += 10
         reasons.append("traffic outside business hours")
     
     reason = "rule-based detection: " + (", ".join(reasons) if reasons else "normal traffic")
     
-    return jsonify({
+    return ojson({
         'score': float(score),
         'is_anomaly': score > 50,
         'reason': reason
@@ -237,7 +623,8 @@ if __name__ == '__main__':
     print("  POST /train         - Train model on normal traffic")
     print("  POST /predict       - Predict single flow (requires trained model)")
     print("  POST /batch_predict - Predict multiple flows (requires trained model)")
+    print("  POST /batch_predict_stream - Predict newline-delimited JSON flows, streamed")
     print("  POST /detect        - Detect anomalous flows (with fallback)")
     print("  GET  /health        - Health check")
-    app.run(host='0.0.0.0', port=5000, debug=False)
-    app.run(host='0.0.0.0', port=5000, debug=True)
+    # Development server only; use gunicorn_conf.py in production
+    app.run(host='0.0.0.0', port=5000, threaded=True, debug=False)
@@ -1,11 +1,17 @@
 import unittest
 import json
+import os
+import subprocess
 import sys
+import tempfile
+import zlib
+from unittest import mock
 from datetime import datetime
+import numpy as np
 sys.path.insert(0, '.')
 
 import service
-from service import app, extract_features
+from service import app, build_features, extract_features, extract_features_batch
 
 
 class TestAnomalyDetectionService(unittest.TestCase):
@@ -20,6 +26,9 @@ class TestAnomalyDetectionService(unittest.TestCase):
         # Reset global state in the service module
         service.model = None
         service.training_data = []
+        service.MODEL_FILE = None
+        service._model_mtime = None
+        service._score_features.cache_clear()
     
     def test_health_endpoint(self):
         """Test health check endpoint"""
@@ -95,6 +104,117 @@ class TestAnomalyDetectionService(unittest.TestCase):
         # Default bytes should be 0
         self.assertEqual(features[4], 0)
     
+    def test_timestamp_hour(self):
+        """Test hour extraction from ISO-8601 timestamps"""
+        # Fast path: hour sliced out of 'YYYY-MM-DDTHH...'
+        self.assertEqual(service._ts_hour('2025-10-09T03:00:00'), 3)
+        self.assertEqual(service._ts_hour('2025-10-09 23:59:59.123456+05:00'), 23)
+        
+        # Other ISO forms fall back to fromisoformat
+        self.assertEqual(service._ts_hour('2025-10-09'), 0)
+        self.assertEqual(service._ts_hour('20251009T101500'), 10)
+        
+        # Out-of-range hours are still rejected
+        with self.assertRaises(ValueError):
+            service._ts_hour('2025-10-09T99:00')
+    
+    def test_feature_extraction_missing_timestamp(self):
+        """Test flows without a timestamp use the current hour"""
+        with mock.patch.object(service, 'datetime', wraps=datetime) as mock_datetime:
+            mock_datetime.now.return_value = datetime(2025, 10, 9, 17, 30)
+            
+            self.assertEqual(extract_features({})[5], 17)
+            self.assertEqual(extract_features_batch([{}])[0, 5], 17)
+        
+        # An explicitly empty timestamp maps to hour 0
+        self.assertEqual(extract_features({'timestamp': ''})[5], 0)
+    
+    def test_feature_extraction_batch(self):
+        """Test batch feature extraction matches per-flow extraction"""
+        flows = [
+            {
+                'source_ip': '192.168.1.100',
+                'dest_ip': '10.0.0.50',
+                'protocol': 'TCP',
+                'port': 443,
+                'bytes': 1024,
+                'timestamp': '2025-10-09T10:00:00'
+            },
+            {
+                'source_ip': '10.0.1.1',
+                'dest_ip': '10.0.1.2',
+                'protocol': 'UDP',
+                'port': 53,
+                'bytes': 512,
+                'timestamp': '2025-10-09T03:30:00'
+            },
+            # Fractional and out-of-int32-range ports are kept as sent
+            {'port': 443.7, 'timestamp': '2025-10-09T10:00:00'},
+            {'port': 1099511627776, 'timestamp': '2025-10-09T10:00:00'},
+            {}
+        ]
+        
+        X = extract_features_batch(flows)
+        
+        # Should return one row of 6 float32 features per flow
+        self.assertEqual(X.shape, (5, 6))
+        self.assertEqual(X.dtype, np.float32)
+        
+        for row, flow in zip(X, flows):
+            np.testing.assert_array_equal(row, np.asarray(extract_features(flow), dtype=np.float32))
+    
+    def test_ip_encoding(self):
+        """Test IPv4 addresses are packed into stable, ordered integers"""
+        features = extract_features({'source_ip': '10.0.0.1', 'dest_ip': '192.168.1.100'})
+        
+        self.assertEqual(features[0], 10 << 24 | 1)
+        self.assertEqual(features[1], 192 << 24 | 168 << 16 | 1 << 8 | 100)
+        
+        # Non-IPv4 strings still map to a deterministic uint32
+        ips = service.ip_to_u32(['10.0.0.1', '10.0.0.2', 'fe80::1', 'not-an-ip'])
+        self.assertEqual(ips.dtype, np.uint32)
+        self.assertEqual(ips[1] - ips[0], 1)
+        self.assertEqual(ips[2], service.ip_to_u32(['fe80::1'])[0])
+        
+        # Non-ASCII digits and non-string values fall back to CRC32
+        self.assertEqual(service._ip_to_int('1.2.3.\u00b2'), zlib.crc32('1.2.3.\u00b2'.encode()))
+        self.assertEqual(service._ip_to_int('1.2.3.\u0663'), zlib.crc32('1.2.3.\u0663'.encode()))
+        self.assertEqual(service._ip_to_int(None), zlib.crc32(b'None'))
+    
+    def test_null_ip_fields(self):
+        """Test flows with null IP fields are scored rather than rejected"""
+        training_flows = [
+            {'source_ip': f'192.168.1.{i}', 'dest_ip': '10.0.0.1', 'port': 80, 'bytes': 500 + i}
+            for i in range(10)
+        ]
+        self.client.post('/train',
+                        data=json.dumps(training_flows),
+                        content_type='application/json')
+        
+        flow = {'source_ip': None, 'dest_ip': '1.2.3.\u00b2', 'port': 80, 'bytes': 500}
+        for endpoint, payload in (('/detect', flow), ('/predict', flow), ('/batch_predict', [flow])):
+            response = self.client.post(endpoint,
+                                        data=json.dumps(payload),
+                                        content_type='application/json')
+            self.assertEqual(response.status_code, 200, endpoint)
+    
+    def test_build_features(self):
+        """Test packing pre-parsed numeric columns into a feature matrix"""
+        X = build_features(
+            np.array([3456, 42]),
+            np.array([7, 0]),
+            np.array([443, 53]),
+            np.array([1, 2]),
+            np.array([1024, 512]),
+            np.array([10, 3])
+        )
+        
+        self.assertEqual(X.dtype, np.float32)
+        self.assertEqual(X.tolist(), [
+            [3456, 7, 443, 1, 1024, 10],
+            [42, 0, 53, 2, 512, 3]
+        ])
+    
     def test_train_endpoint(self):
         """Test model training endpoint"""
         training_flows = [
@@ -136,6 +256,57 @@ class TestAnomalyDetectionService(unittest.TestCase):
         self.assertIn('samples', data)
         self.assertEqual(data['samples'], 3)
     
+    def test_train_publishes_fitted_model(self):
+        """Test the previous model keeps serving until the new one is fitted"""
+        X = np.array([[i, i, 80, 1, 500 + i * 10, 12] for i in range(20)])
+        previous = service.HBOS().fit(X)
+        service.model = previous
+        
+        def fit(estimator, X):
+            # A concurrent request during the fit still sees the old model
+            self.assertIs(service.model, previous)
+            return original_fit(estimator, X)
+        
+        original_fit = service.HBOS.fit
+        with mock.patch.object(service, 'MODEL_KIND', 'hbos'), \
+                mock.patch.object(service.HBOS, 'fit', autospec=True, side_effect=fit):
+            response = self.client.post('/train',
+                                        data=json.dumps([{'port': 80, 'bytes': i} for i in range(5)]),
+                                        content_type='application/json')
+        
+        self.assertEqual(response.status_code, 200)
+        self.assertIsNot(service.model, previous)
+        self.assertTrue(hasattr(service.model, 'edges_'))
+    
+    def test_train_endpoint_downsamples(self):
+        """Test oversized training payloads are down-sampled to MAX_TRAIN"""
+        training_flows = [
+            {
+                'source_ip': f'192.168.1.{i}',
+                'dest_ip': '10.0.0.1',
+                'protocol': 'TCP',
+                'port': 80,
+                'bytes': 500 + i,
+                'timestamp': '2025-10-09T10:00:00'
+            }
+            for i in range(50)
+        ]
+        
+        max_train = service.MAX_TRAIN
+        service.MAX_TRAIN = 20
+        try:
+            response = self.client.post('/train',
+                                        data=json.dumps({'flows': training_flows}),
+                                        content_type='application/json')
+        finally:
+            service.MAX_TRAIN = max_train
+        
+        self.assertEqual(response.status_code, 200)
+        
+        data = json.loads(response.data)
+        self.assertEqual(data['samples'], 20)
+        self.assertEqual(len(service.training_data), 20)
+    
     def test_train_endpoint_insufficient_data(self):
         """Test training with insufficient data"""
         training_flows = [
@@ -293,6 +464,265 @@ class TestAnomalyDetectionService(unittest.TestCase):
             self.assertIn('anomaly', pred)
             self.assertIn('score', pred)
     
+    def test_score_flows_chunked(self):
+        """Test chunked scoring matches scoring the whole batch at once"""
+        flows = [
+            {
+                'source_ip': f'192.168.1.{i}',
+                'dest_ip': '10.0.0.1',
+                'protocol': 'TCP',
+                'port': 443 if i % 5 else 22,
+                'bytes': 1000 + i,
+                'timestamp': '2025-10-09T10:00:00'
+            }
+            for i in range(25)
+        ]
+        model = service.build_model(len(flows)).fit(extract_features_batch(flows))
+        
+        chunk = service.SCORE_CHUNK
+        service.SCORE_CHUNK = 4
+        try:
+            scores = service.score_flows(model, flows)
+        finally:
+            service.SCORE_CHUNK = chunk
+        
+        np.testing.assert_allclose(scores, model.decision_function(extract_features_batch(flows)))
+    
+    def test_hbos_detector(self):
+        """Test HBOS flags out-of-distribution flows and matches the sklearn API"""
+        rng = np.random.default_rng(42)
+        X = np.column_stack([
+            rng.integers(0, 100, 500),
+            rng.integers(0, 100, 500),
+            np.full(500, 443),
+            np.ones(500),
+            rng.normal(1000, 50, 500),
+            rng.integers(9, 17, 500)
+        ])
+        
+        detector = service.HBOS(contamination=0.1).fit(X)
+        
+        # Roughly the contamination fraction of training data is flagged
+        train_preds = detector.predict(X)
+        self.assertLessEqual(np.mean(train_preds == -1), 0.15)
+        
+        outlier = np.array([[50, 50, 9999, 3, 999999, 3]])
+        self.assertEqual(detector.predict(outlier)[0], -1)
+        self.assertLess(detector.decision_function(outlier)[0], 0)
+    
+    def test_predict_single_decision_pass(self):
+        """Test /predict labels flows from one decision_function call"""
+        X = np.array([[i, i, 80, 1, 500 + i * 10, 12] for i in range(20)])
+        service.model = service.IsolationForest(random_state=42, n_estimators=10).fit(X)
+        
+        flows = [
+            {'source_ip': '0.0.0.5', 'dest_ip': '0.0.0.5', 'protocol': 'TCP',
+             'port': 80, 'bytes': 550, 'timestamp': '2025-10-09T12:00:00'},
+            {'source_ip': '1.2.3.4', 'dest_ip': '5.6.7.8', 'protocol': 'ICMP',
+             'port': 9999, 'bytes': 999999, 'timestamp': '2025-10-09T03:00:00'}
+        ]
+        
+        # predict() would walk every tree a second time
+        with mock.patch.object(service.model, 'predict', side_effect=AssertionError):
+            responses = [self.client.post('/predict',
+                                          data=json.dumps(flow),
+                                          content_type='application/json')
+                         for flow in flows]
+        
+        expected = service.model.predict(extract_features_batch(flows))
+        self.assertEqual([json.loads(r.data)['is_anomaly'] for r in responses],
+                         [bool(p == -1) for p in expected])
+    
+    def test_score_cache_keyed_on_model(self):
+        """Test a cached score is never served for a different model"""
+        X = np.array([[i, i, 80, 1, 500 + i * 10, 12] for i in range(20)])
+        old_model = service.HBOS().fit(X)
+        new_model = service.HBOS().fit(X * 10)
+        features = (5.0, 5.0, 80.0, 1.0, 550.0, 12.0)
+        
+        # A request that started before a retrain caches the old model's score
+        old_score = service._score_features(old_model, features)
+        new_score = service._score_features(new_model, features)
+        
+        self.assertNotAlmostEqual(old_score, new_score)
+        self.assertAlmostEqual(
+            new_score, new_model.decision_function(np.array([features]))[0])
+        
+        # Repeated flows are served from the cache
+        with mock.patch.object(new_model, 'decision_function', side_effect=AssertionError):
+            self.assertEqual(service._score_features(new_model, features), new_score)
+    
+    def test_predict_batcher(self):
+        """Test concurrent submissions are scored together and fanned back out"""
+        X = np.array([[i, i, 80, 1, 500 + i * 10, 12] for i in range(10)])
+        model = service.IsolationForest(random_state=42, n_estimators=10).fit(X)
+        
+        batcher = service.PredictBatcher(max_batch=4, max_wait_ms=50)
+        rows = [[i, i, 80, 1, 500, 12] for i in range(6)] + [[9999, 9999, 9999, 3, 999999, 3]]
+        futures = [batcher.submit(model, row) for row in rows]
+        
+        expected_preds = model.predict(np.array(rows))
+        expected_scores = model.decision_function(np.array(rows))
+        for future, pred, score in zip(futures, expected_preds, expected_scores):
+            result_score = future.result(timeout=5)
+            self.assertAlmostEqual(result_score, score)
+            
+            # Thresholding the score must agree with model.predict
+            self.assertEqual(result_score < 0, pred == -1)
+    
+    def test_model_persistence(self):
+        """Test a trained model is saved and reloaded from MODEL_PATH"""
+        training_flows = [
+            {
+                'source_ip': f'192.168.1.{i}',
+                'dest_ip': '10.0.0.1',
+                'protocol': 'TCP',
+                'port': 80,
+                'bytes': 500 + i * 10,
+                'timestamp': '2025-10-09T10:00:00'
+            }
+            for i in range(10)
+        ]
+        
+        with tempfile.TemporaryDirectory() as model_dir:
+            service.MODEL_FILE = os.path.join(model_dir, 'model.joblib')
+            
+            response = self.client.post('/train',
+                                        data=json.dumps({'flows': training_flows}),
+                                        content_type='application/json')
+            self.assertEqual(response.status_code, 200)
+            self.assertTrue(os.path.exists(service.MODEL_FILE))
+            
+            trained = service.model
+            
+            # Simulate a fresh worker loading the persisted model
+            service.model = None
+            service._model_mtime = None
+            service.load_model()
+            self.assertIsNotNone(service.model)
+            self.assertIsNot(service.model, trained)
+            
+            X = extract_features_batch(training_flows)
+            np.testing.assert_allclose(service.model.decision_function(X),
+                                       trained.decision_function(X))
+            
+            response = self.client.post('/predict',
+                                        data=json.dumps(training_flows[0]),
+                                        content_type='application/json')
+            self.assertEqual(response.status_code, 200)
+    
+    def test_batch_predict_stream(self):
+        """Test streaming newline-delimited JSON batch prediction"""
+        training_flows = [
+            {
+                'source_ip': f'192.168.1.{i}',
+                'dest_ip': '10.0.0.1',
+                'protocol': 'TCP',
+                'port': 443,
+                'bytes': 1000,
+                'timestamp': '2025-10-09T10:00:00'
+            }
+            for i in range(10)
+        ]
+        
+        self.client.post('/train',
+                        data=json.dumps({'flows': training_flows}),
+                        content_type='application/json')
+        
+        # Use a small chunk so the stream is scored across several chunks
+        chunk = service.SCORE_CHUNK
+        service.SCORE_CHUNK = 2
+        try:
+            lines = [json.dumps(flow) for flow in training_flows[:3]]
+            lines.insert(1, 'invalid json{')
+            
+            # Well-formed objects with bad fields fail only their own line
+            lines.insert(3, json.dumps(dict(training_flows[0], timestamp='garbage')))
+            lines.insert(4, json.dumps(dict(training_flows[0], port=None)))
+            response = self.client.post('/batch_predict_stream',
+                                        data='\n'.join(lines) + '\n',
+                                        content_type='application/x-ndjson')
+            body = response.get_data()
+        finally:
+            service.SCORE_CHUNK = chunk
+        
+        self.assertEqual(response.status_code, 200)
+        
+        results = {r['index']: r for r in map(json.loads, body.splitlines())}
+        self.assertEqual(sorted(results), [0, 1, 2, 3, 4, 5])
+        for index in (1, 3, 4):
+            self.assertIn('error', results[index])
+        for index in (0, 2, 5):
+            self.assertIn('anomaly', results[index])
+            self.assertIn('score', results[index])
+    
+    def test_batch_predict_stream_no_model(self):
+        """Test streaming prediction without training first"""
+        response = self.client.post('/batch_predict_stream',
+                                    data='{}\n',
+                                    content_type='application/x-ndjson')
+        
+        self.assertEqual(response.status_code, 400)
+    
+    def test_model_trained_under_main_loads_in_service(self):
+        """Test a model trained via `python3 service.py` loads under Gunicorn"""
+        script = (
+            'import flask, json, runpy\n'
+            'flask.Flask.run = lambda *args, **kwargs: None\n'
+            'ns = runpy.run_path("service.py", run_name="__main__")\n'
+            'flows = [{"port": 80, "bytes": 500 + i} for i in range(10)]\n'
+            'response = ns["app"].test_client().post("/train", json=flows)\n'
+            'assert response.status_code == 200, response.data\n'
+        )
+        
+        with tempfile.TemporaryDirectory() as model_dir:
+            result = subprocess.run(
+                [sys.executable, '-c', script],
+                cwd=os.path.dirname(os.path.abspath(service.__file__)),
+                env=dict(os.environ, MODEL_PATH=model_dir, MODEL_KIND='hbos'),
+                capture_output=True, text=True
+            )
+            self.assertEqual(result.returncode, 0, result.stderr)
+            
+            service.MODEL_FILE = os.path.join(model_dir, 'model.joblib')
+            service.load_model()
+            self.assertIsInstance(service.model, service.HBOS)
+    
+    def test_corrupt_model_file(self):
+        """Test an unloadable model file falls back to untrained, not a crash"""
+        with tempfile.TemporaryDirectory() as model_dir:
+            with open(os.path.join(model_dir, 'model.joblib'), 'wb') as f:
+                f.write(b'not a pickle')
+            
+            # Importing the service loads the model at startup
+            result = subprocess.run(
+                [sys.executable, '-c',
+                 'import service; '
+                 'print(service.app.test_client().get("/health").get_data(as_text=True))'],
+                cwd=os.path.dirname(os.path.abspath(service.__file__)),
+                env=dict(os.environ, MODEL_PATH=model_dir),
+                capture_output=True, text=True
+            )
+            self.assertEqual(result.returncode, 0, result.stderr)
+            self.assertEqual(json.loads(result.stdout.strip().splitlines()[-1])['model_trained'], False)
+            
+            service.MODEL_FILE = os.path.join(model_dir, 'model.joblib')
+            with mock.patch.object(service.joblib, 'load', wraps=service.joblib.load) as load, \
+                    mock.patch.object(service.app.logger, 'exception'):
+                for _ in range(2):
+                    response = self.client.get('/health')
+                    self.assertEqual(response.status_code, 200)
+                    self.assertFalse(json.loads(response.data)['model_trained'])
+                
+                # The bad file is only read once until it changes
+                self.assertEqual(load.call_count, 1)
+            
+            # Untrained /detect still uses the rule-based fallback
+            response = self.client.post('/detect',
+                                        data=json.dumps({'port': 22}),
+                                        content_type='application/json')
+            self.assertEqual(response.status_code, 200)
+    
     def test_invalid_json(self):
         """Test handling of invalid JSON"""
         response = self.client.post('/train',